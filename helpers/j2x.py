@@ -9,17 +9,78 @@
 # This program reads JSON input and applies it to a filesystem object as
 # extended attributes (xattrs).
 
-import argparse
 import json
 import sys
 import os
-import traceback
-import time
+import stat
+
+from collections import namedtuple
+from types import SimpleNamespace
 
 
 # --- Commandline parameters:
 
+# When j2x is called once per file (e.g. from `find -exec`), startup time
+# matters. Importing argparse and building the parser takes a few ms, so plain
+# invocations like `j2x -t FILE -j FILE.json` are parsed by hand instead.
+# Anything else (help, unknown or combined options, missing values, ...) is
+# left to argparse.
+# (For the same reason, modules only needed by some options are imported
+# where they're used, not up here.)
+FAST_DEFAULTS = {
+        'verbose': 0,
+        'quiet': False,
+        'target': None,
+        'json': None,
+        'prefix': 'user.',
+        'archive': False,
+        'lower_key': False,
+        'lower_value': False,
+        'clear_first': False,
+        'empty_values': False,
+        'jobs': 1,
+        'target_list': None,
+        'stream': False,
+        }
+FAST_FLAGS = {
+        '-q': 'quiet', '--quiet': 'quiet',
+        '-a': 'archive', '--archive': 'archive',
+        '-lk': 'lower_key', '--lower_key': 'lower_key',
+        '-lv': 'lower_value', '--lower_value': 'lower_value',
+        '-c': 'clear_first', '--clear_first': 'clear_first',
+        '-ev': 'empty_values', '--empty_values': 'empty_values',
+        '--stream': 'stream',
+        }
+FAST_VALUES = {
+        '-t': 'target', '--target': 'target',
+        '-j': 'json', '--json': 'json',
+        '-p': 'prefix', '--prefix': 'prefix',
+        }
+
+# Returns the parsed options, or None if argparse is needed.
+def fast_parse_args(argv):
+    values = dict(FAST_DEFAULTS)
+    argv = iter(argv)
+    for arg in argv:
+        if arg in FAST_FLAGS:
+            values[FAST_FLAGS[arg]] = True
+        elif arg in ('-v', '--verbose'):
+            values['verbose'] += 1
+        elif arg in FAST_VALUES:
+            value = next(argv, None)
+            if (value is None) or (value.startswith('-') and value != '-'):
+                return None
+            values[FAST_VALUES[arg]] = value
+        else:
+            return None
+
+    if (values['target'] is None) or (values['json'] is None):
+        return None
+    return SimpleNamespace(**values)
+
 def parse_args():
+    import argparse     # only needed if the fast path didn't do.
+
     parser = argparse.ArgumentParser(
             description='Write JSON data as xattrs to a file.'
             )
@@ -35,15 +96,16 @@ def parse_args():
             )
     parser.add_argument('-t', '--target',
             type=str,
-            required=True,
             help='A filename to write xattrs to.'
             )
     parser.add_argument('-j', '--json',
             type=str,
-            required=True,
-            default='-',
             help='A filename containing JSON data to write as xattrs, or - to read JSON data from standard input.'
             )
+    parser.add_argument('--target-list',
+            type=str,
+            help='A file with one "target<TAB>json file" pair per line, or - to read them from standard input. Replaces -t and -j.'
+            )
     parser.add_argument('-p', '--prefix',
             type=str,
             default='user.',
@@ -74,9 +136,33 @@ def parse_args():
             action='store_true',
             help='By default, empty values will NOT be written to target. Use this to write empty values.'
             )
+    parser.add_argument('--stream',
+            default=False,
+            action='store_true',
+            help='Only parse the first record of a JSON list, without loading all of the input into memory (requires ijson). NaN/Infinity are not supported, and integers beyond 64 bits only if the JSON input is a file.'
+            )
+    parser.add_argument('--jobs',
+            type=int,
+            default=1,
+            help='Number of threads for writing/removing xattrs. May speed things up on network/FUSE filesystems. Default: 1'
+            )
 
     return parser
 
+def get_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = fast_parse_args(argv)
+    if args is None:
+        parser = parse_args()
+        args = parser.parse_args(argv)
+        if args.target_list is None:
+            if (args.target is None) or (args.json is None):
+                parser.error("-t/--target and -j/--json are required (unless --target-list is used).")
+        elif (args.target is not None) or (args.json is not None):
+            parser.error("--target-list can't be combined with -t/--target or -j/--json.")
+    return args
+
 def handle_args(args):
     # TODO: args.json: check if file exists.
     if (args.verbose > 0) and (not args.quiet):
@@ -85,40 +171,167 @@ def handle_args(args):
         if (args.verbose > 1):
             print("Used configuration:")
             print("------------------------")
-            print("Target:          {}".format(args.target))
+            if args.target_list is None:
+                print("Target:          {}".format(args.target))
+            else:
+                print("Target list:     {}".format(args.target_list))
             print("Default prefix:  {}".format(args.prefix))
             print("Lowercase key:   {}".format(args.lower_key))
             print("Lowercase value: {}".format(args.lower_value))
             print("Clear first:     {}".format(args.clear_first))
             print("Empty values:    {}".format(args.empty_values))
+            print("Stream JSON:     {}".format(args.stream))
+            print("Jobs:            {}".format(args.jobs))
             print("------------------------")
 
         print("\n")
 
+# Options needed while writing xattrs.
+# Passed around explicitly, so the per-attribute code doesn't have to look up
+# a global `args` object all the time.
+# (A namedtuple, because importing `dataclasses` costs more startup time than
+# we'd like for a tool that gets called once per file.)
+CFG_OPTIONS = ('archive', 'lower_key', 'lower_value', 'empty_values',
+        'verbose', 'quiet', 'jobs')
+
+# Verbosity levels, precomputed: `vN` is True for verbose >= N.
+CFG_LEVELS = ('v1', 'v2', 'v3', 'v4', 'v5')
+
+class Cfg(namedtuple('Cfg', CFG_OPTIONS + CFG_LEVELS)):
+    __slots__ = ()
+
+    def __new__(cls, archive=False, lower_key=False, lower_value=False,
+            empty_values=False, verbose=0, quiet=False, jobs=1):
+        levels = [verbose >= level for level in range(1, len(CFG_LEVELS) + 1)]
+        return super().__new__(cls, archive, lower_key, lower_value,
+                empty_values, verbose, quiet, jobs, *levels)
+
+    # Same as namedtuple's, but keeps the verbosity levels in sync:
+    def _replace(self, **changes):
+        options = {name: getattr(self, name) for name in CFG_OPTIONS}
+        options.update(changes)
+        return Cfg(**options)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+                archive=args.archive,
+                lower_key=args.lower_key,
+                lower_value=args.lower_value,
+                empty_values=args.empty_values,
+                verbose=args.verbose,
+                quiet=args.quiet,
+                jobs=args.jobs,
+                )
+
+BYTE_UNITS = ('bytes', 'kB', 'MB', 'GB', 'TB')
+
 # This function will convert bytes to MB.... GB... etc
 # use "step_unit=1024.0" for KiB, etc.
 # use "step_unit=1000.0" for kilo (=1000), etc.
 def convert_bytes(num, step_unit=1024.0):
-    for x in ['bytes', 'kB', 'MB', 'GB', 'TB']:
+    if step_unit == 1024:
+        # Every 10 bits are one unit step, so no need to divide our way there:
+        unit = min(max(int(num).bit_length() - 1, 0) // 10, len(BYTE_UNITS) - 1)
+        return f"{num / (1 << (10 * unit)):3.1f} {BYTE_UNITS[unit]}"
+
+    for x in BYTE_UNITS[:-1]:
         if num < step_unit:
-            return "%3.1f %s" % (num, x)
+            return f"{num:3.1f} {x}"
         num /= step_unit
+    return f"{num:3.1f} {BYTE_UNITS[-1]}"
 
 
 # --- handling JSON data:
 
-def read_json_file(filename):
-    with open(filename, 'r') as f:
-        data = json.load(f)
+# Optional: orjson parses large JSON input faster. But importing it takes
+# longer (~9 ms) than json needs for a typical (small) exiftool record, and it
+# only saves a few ms per MB, so it's only used for input at least this big:
+ORJSON_MIN_SIZE = 4 * 1024 * 1024
+
+# orjson silently turns integers beyond 64 bits into floats. So if the input
+# has a run of 19+ digits anywhere, json is used instead. Mapping all digits
+# to b'0' (and everything else to b' ') makes that a plain substring search:
+DIGITS_ONLY = bytes(ord('0') if chr(byte).isdigit() else ord(' ') for byte in range(128)) + b' ' * 128
+LONG_NUMBER = b'0' * 19
+
+# Parse JSON from bytes. Same results as json.loads(), just faster for large
+# input if orjson is available.
+def parse_json(raw):
+    if (len(raw) >= ORJSON_MIN_SIZE) and (LONG_NUMBER not in raw.translate(DIGITS_ONLY)):
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+
+        if orjson is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # orjson is stricter (NaN, lone surrogates, non-UTF-8, ...),
+                # so let json decide:
+                pass
+    return json.loads(raw)
+
+# Parse JSON from a binary file object.
+# With `stream`, only the first record of a top-level JSON list is parsed
+# (using ijson), instead of reading all of them into memory first.
+# Without ijson installed, everything is parsed as usual.
+def load_json(fp, stream=False):
+    if stream:
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+
+        if ijson is not None:
+            # Where the JSON data starts, in case we need to start over:
+            start = fp.tell() if fp.seekable() else None
+            try:
+                return stream_json(fp, ijson)
+            except ijson.JSONError as e:
+                # The (default) C backend can't do integers beyond 64 bits.
+                # The Python backend can, but is much slower: so only use it
+                # if really needed, and if we can start over.
+                if 'integer overflow' not in str(e):
+                    raise
+                if start is None:
+                    raise ValueError("--stream can't read integers beyond 64 bits from a pipe. Run without --stream.") from None
+                fp.seek(start)
+                return stream_json(fp, ijson.get_backend('python'))
+
+    return parse_json(fp.read())
+
+# Parse the first record of a top-level JSON list, or the top-level object
+# (or whatever else is there) as a whole, with the given ijson backend.
+# Like json, but doesn't support NaN/Infinity.
+def stream_json(fp, ijson):
+    import itertools
+
+    events = ijson.parse(fp, use_float=True)
+    first = next(events)
+    events = itertools.chain([first], events)
+
+    if first[1] != 'start_array':
+        return next(ijson.items(events, ''))
+
+    try:
+        return [next(ijson.items(events, 'item'))]
+    except StopIteration:
+        raise ValueError("No records found in JSON list to stream.") from None
+
+def read_json_file(filename, stream=False):
+    with open(filename, 'rb') as f:
+        data = load_json(f, stream)
     return data
 
-def read_json_stdin():
+def read_json_stdin(stream=False):
     data = None
     if sys.stdin.isatty():
         print("No JSON data provided in standard input. Exiting...")
         sys.exit(1)
     else:
-        data = json.load(sys.stdin)
+        data = load_json(sys.stdin.buffer, stream)
     return data
 
 def show_json(json):
@@ -127,162 +340,283 @@ def show_json(json):
 
 # --- handling extended attributes:
 
-def clean_key(key):
-    global args
-
-    out = str(key).strip()
-    if (not args.archive and args.lower_key):
+# JSON keys are always strings (and values mostly are), so only convert if
+# needed, and only strip if there's whitespace at either end.
+def clean_key(key, cfg):
+    out = key if type(key) is str else str(key)
+    if out and (out[0].isspace() or out[-1].isspace()):
+        out = out.strip()
+    if (not cfg.archive and cfg.lower_key):
         out = out.lower()
     return out
 
-def clean_value(value):
-    out = str(value).strip()
-    if (not args.archive and args.lower_value):
+def clean_value(value, cfg):
+    out = value if type(value) is str else str(value)
+    if out and (out[0].isspace() or out[-1].isspace()):
+        out = out.strip()
+    if (not cfg.archive and cfg.lower_value):
         out = out.lower()
     return out
 
-def write_xattrs_list(target, data, prefix=None, archive=True):
+# Stores a list of {"key": ..., "value": ...} objects as xattrs to `target`.
+def write_xattrs_list(target, data, prefix_b, cfg, fd=None):
     if not isinstance(data, list):
         raise ValueError("data must be a list")
 
-    for key, value in data.items():
-        try:
-            written = write_xattr(target, key, value, prefix, archive)
-        except Exception as e:
-            print("ERROR: could not write '{} = {}'.".format(key, value))
-            print(e)
-            sleep(1)
-            raise(e)
-            break
-
-    return written
-
-def write_xattrs_dict(target, data, prefix=None, archive=True):
-    global args
+    pairs = [(item['key'], item['value']) for item in data]
+    return write_xattr_pairs(target, pairs, prefix_b, cfg, fd)
 
+def write_xattrs_dict(target, data, prefix_b, cfg, fd=None):
     if not isinstance(data, dict):
         raise ValueError("data must be a dictionary")
 
-    total = {}
-    total['keys'] = 0
-    total['values'] = 0
-
-    for key, value in data.items():
-        try:
-            written = write_xattr(target, key, value, prefix, archive)
-            # Add byte sizes:
-            total['keys'] += written['keys']
-            total['values'] += written['values']
-
-            if (args.verbose > 1):
-                #print("current: {} +{}".format(total['keys'], total['values']))
-                pass
-
-        except Exception as e:
-            print("ERROR: could not write '{} = {}'.".format(key, value))
-            #traceback.print_exc()
-            print(e)
-            time.sleep(1)
-            raise(e)
-
-    total['sum'] = total['keys'] + total['values']
-
-    if (args.verbose > 0):
-        if (args.quiet):
+    return write_xattr_pairs(target, data.items(), prefix_b, cfg, fd)
+
+# Writes (key, value) pairs as xattrs to `target`.
+# `pairs` must support len(), e.g. a list or dict.items().
+# `fd` is an optional file descriptor of `target` that is already open.
+def write_xattr_pairs(target, pairs, prefix_b, cfg, fd=None):
+    # Byte sizes written, for keys and values:
+    k_total = 0
+    v_total = 0
+
+    # Open the target only once and write all pairs through that descriptor,
+    # instead of having each os.setxattr() resolve the path again.
+    # (`fd` may also end up being the path, if the target can't be opened.)
+    own_fd = fd is None
+    if own_fd:
+        fd = open_target(target)
+    try:
+        # Fetch the existing keys once, instead of finding out per key:
+        existing = {os.fsencode(key) for key in os.listxattr(fd)}
+
+        if cfg.jobs > 1:
+            # Each os.setxattr() releases the GIL, so threads help when the
+            # filesystem is slow to answer (network, FUSE, ...).
+            from concurrent.futures import ThreadPoolExecutor
+            from threading import Event
+
+            # Like the sequential loop below, stop at the first error:
+            # Keys that haven't started yet are skipped. Only the ones that
+            # are being written at that moment (at most one per thread) may
+            # still end up on the target.
+            failed = Event()
+
+            def write_item(item):
+                if failed.is_set():
+                    return NOTHING_WRITTEN
+                key, value = item
+                try:
+                    return write_xattr(fd, key, value, prefix_b, cfg, existing)
+                except Exception as e:
+                    failed.set()
+                    name_target_error(e, fd, target)
+                    print("ERROR: could not write '{} = {}' on '{}'.".format(key, value, target))
+                    print(e)
+                    raise(e)
+
+            with ThreadPoolExecutor(max_workers=cfg.jobs) as executor:
+                try:
+                    for k_bytes, v_bytes in executor.map(write_item, pairs):
+                        # Add byte sizes:
+                        k_total += k_bytes
+                        v_total += v_bytes
+                except Exception:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        else:
+            for key, value in pairs:
+                try:
+                    k_bytes, v_bytes = write_xattr(fd, key, value, prefix_b, cfg, existing)
+                    # Add byte sizes:
+                    k_total += k_bytes
+                    v_total += v_bytes
+
+                except Exception as e:
+                    name_target_error(e, fd, target)
+                    print("ERROR: could not write '{} = {}' on '{}'.".format(key, value, target))
+                    print(e)
+                    raise(e)
+    finally:
+        if own_fd:
+            close_target(fd)
+
+    total = {
+            'keys': k_total,
+            'values': v_total,
+            'sum': k_total + v_total,
+            }
+
+    if cfg.v1:
+        if (cfg.quiet):
             print(".", end='')
         else:
             print() # linebreak if verbose
 
-    if (not args.quiet):
-        print("wrote {} ({} +{}) / {} as attributes on '{}'.".format(
+    if (not cfg.quiet):
+        print("wrote {} ({} +{}) from {} keys as attributes on '{}'.".format(
             convert_bytes(total['sum']),
             total['keys'], total['values'],
-            convert_bytes(sys.getsizeof(data)),
+            len(pairs),
             target
             ))
 
-    return written
+    return total
 
 # Stores a list or dict of key/value pairs as xattrs to `target`.
-def write_xattrs(target, data, prefix=None, archive=True):
+# `fd` is an optional file descriptor of `target` that is already open.
+def write_xattrs(target, data, prefix, cfg, fd=None):
+    # The prefix is the same for all keys, so encode it only once:
+    prefix_b = prefix.encode()
+
     written = {}
     if isinstance(data, dict):
-        written = write_xattrs_dict(target, data, prefix, archive)
+        written = write_xattrs_dict(target, data, prefix_b, cfg, fd)
     elif isinstance(data, list):
-        written = write_xattrs_list(target, data, prefix, archive)
+        written = write_xattrs_list(target, data, prefix_b, cfg, fd)
     else:
         raise ValueError("data must be a dictionary or a list.")
 
     return written
 
+# Byte sizes of (key, value) written by write_xattr(), if it skipped a key:
+NOTHING_WRITTEN = (0, 0)
+
 # Store a single xattr, but possibly preprocess/sanitize/normalize key/values
 # before writing it.
-def write_xattr(target, key, value, prefix=None, archive=True):
-    global args
-
-    # Count bytes written as attributes:
-    written = {}
-    written['keys'] = 0
-    written['values'] = 0
-
-    if archive:
-        # preserve:
-        strkey = key
-        strval = value
+# Returns the byte sizes of the (key, value) written as a tuple.
+# `target` may be a path or an already opened file descriptor.
+# `prefix_b` is the attribute namespace prefix, already encoded as bytes.
+# `existing` is an optional set of (encoded) keys already present on target.
+def write_xattr(target, key, value, prefix_b, cfg, existing=None):
+    archive = cfg.archive
+    empty_values = cfg.empty_values
+
+    if archive and empty_values:
+        # Fast path: nothing to clean and nothing to skip, so go straight
+        # from the JSON key/value to bytes.
+        if cfg.v3:
+            print("{} = '{}'".format(key.ljust(30), value)) #debug
+
+        strval = (value if type(value) is str else str(value)).encode()
+        strkey = prefix_b + key.encode()
     else:
-        # clean/strip:
-        strkey = clean_key(key)
-        strval = clean_value(value)
+        if archive:
+            # preserve:
+            strkey = key
+            strval = value
+        else:
+            # clean/strip:
+            strkey = clean_key(key, cfg)
+            strval = clean_value(value, cfg)
 
-    # Skip empty values (unless allowed).
-    if (not strval) and (not args.empty_values):
-        return written
+        # Skip empty values (unless allowed).
+        if (not strval) and (not empty_values):
+            return NOTHING_WRITTEN
 
-    if (args.verbose > 2):
-        print("{} = '{}'".format(strkey.ljust(30), strval)) #debug
+        if cfg.v3:
+            print("{} = '{}'".format(strkey.ljust(30), strval)) #debug
 
-    # We may want to change that when binary data comes in?
-    strval = str(strval).encode() # I have type-doubts and had issues already.
-    strkey = (prefix + strkey).encode() # now it's offical ;P
+        # We may want to change that when binary data comes in?
+        # Cleaned values are str already, archived ones may be anything:
+        strval = (strval if type(strval) is str else str(strval)).encode()
+        strkey = prefix_b + (strkey if isinstance(strkey, bytes) else strkey.encode()) # now it's offical ;P
+
+    # Existing keys won't be overwritten anyway (XATTR_CREATE), so skip the
+    # ones we already know about without raising a FileExistsError:
+    if (existing is not None) and (strkey in existing):
+        show_existing(strkey, strval, cfg)
+        return NOTHING_WRITTEN
 
     try:
         #print(".", end='')
-        # This is where things get written for real:
-        os.setxattr(target, strkey, strval, flags=os.XATTR_CREATE)
-
-        if (args.verbose > 3):
-            # Show information about current key/value set:
-            print("current: {} +{} - '{}' = '{}'".format(
-                len(strkey),
-                len(strval),
-                strkey.decode(),
-                strval.decode()
-                ))
-
-            print("blip!")
-        written['keys'] += len(strkey)
-        written['values'] += len(strval)
+        # This is where things get written for real.
+        # (os.setxattr() releases the GIL during the syscall, so there's no
+        # need for a compiled version of this to make --jobs work.)
+        os.setxattr(target, strkey, strval, os.XATTR_CREATE)
     except FileExistsError:
-        if (args.verbose == 1) and (not args.quiet):
-            print('*', end='')
-        if (args.verbose > 4):
-            print("exists: {} = '{}'".format(strkey.ljust(30), strval))
+        show_existing(strkey, strval, cfg)
+        return NOTHING_WRITTEN
 
     except Exception as e:
         print("ouch.")
         raise(e)
 
+    if cfg.v4:
+        # Show information about current key/value set:
+        print("current: {} +{} - '{}' = '{}'".format(
+            len(strkey),
+            len(strval),
+            strkey.decode(),
+            strval.decode()
+            ))
+
+        print("blip!")
+
     # Brag how much we've made:
-    return written
+    return (len(strkey), len(strval))
+
+# Report a key that was not written, because it exists already:
+def show_existing(strkey, strval, cfg):
+    if (cfg.verbose == 1) and (not cfg.quiet):
+        print('*', end='')
+    if cfg.v5:
+        print("exists: {} = '{}'".format(strkey.ljust(30), strval))
+
+# Opens `target` for reading/writing its xattrs through the file descriptor.
+# O_RDONLY works on directories, too. Like os.setxattr() on a path, this
+# follows symlinks.
+# Only regular files and directories are opened: opening anything else runs
+# driver code (a watchdog gets armed, a tape rewinds on close, ...), and user.
+# xattrs can't be set on FIFOs or device nodes anyway. Setting xattrs also
+# doesn't need read permission. So in all these cases (and if the target
+# doesn't exist), the path itself is returned. All xattr functions below
+# accept both.
+def open_target(target):
+    try:
+        mode = os.stat(target).st_mode
+        if not (stat.S_ISREG(mode) or stat.S_ISDIR(mode)):
+            return target
+        # O_NONBLOCK, O_NOCTTY: just in case it was swapped in the meantime.
+        return os.open(target, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    except OSError:
+        return target
+
+# Closes what open_target() returned, if it was a file descriptor.
+def close_target(fd):
+    if isinstance(fd, int):
+        os.close(fd)
+
+# Errors from calls on a file descriptor only name its number, so put the
+# name of the file back in:
+def name_target_error(e, fd, target):
+    if isinstance(e, OSError) and isinstance(fd, int) and (e.filename == fd):
+        e.filename = target
+
+# The functions below take a path or an open file descriptor as `target`.
 
 def read_xattrs(target):
     xattrs = os.listxattr(target)
     return xattrs
 
-def clear_xattrs(target):
+# Returns the number of bytes used by all xattrs (keys + values) on `target`.
+# Measured on the raw bytes, so values don't need to be decoded first, and
+# summed up as we go, so they don't need to be kept around either.
+def get_xattrs_size(target):
+    total = 0
+    for key in os.listxattr(target):
+        total += len(os.fsencode(key)) + len(os.getxattr(target, key))
+    return total
+
+def clear_xattrs(target, jobs=1):
     xattrs = os.listxattr(target)
-    for key in xattrs:
-        os.removexattr(target, key)
+    if jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda key: os.removexattr(target, key), xattrs))
+    else:
+        for key in xattrs:
+            os.removexattr(target, key)
 
 
 def show_xattr_limits():
@@ -292,56 +626,123 @@ def show_xattr_limits():
 
 # --- Main function:
 
-def main():
-    # Get commandline arguments/options:
-    parser = parse_args()
-    global args
-    args = parser.parse_args()
-    handle_args(args)
-
-    #print("parsed args.")
-
+# Reads a list of targets and their JSON files: one "target<TAB>json" pair per
+# line. Empty lines are ignored.
+def read_target_list(filename):
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename, 'r') as f:
+            lines = f.read().splitlines()
+
+    targets = []
+    for num, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        pair = line.split('\t')
+        if (len(pair) != 2) or (pair[1] == '-'):
+            print("Invalid line {} in target list '{}': expected 'target<TAB>json file'.".format(num, filename))
+            sys.exit(1)
+        targets.append((pair[0], pair[1]))
+    return targets
+
+# Writes the JSON data from `json_file` as xattrs onto `target`:
+def process_target(target, json_file, args, cfg):
     # Shortcut variables for popular options:
     prefix = args.prefix
-    target = args.target
 
-    if args.json == '-':
-        json_data = read_json_stdin()
+    if json_file == '-':
+        json_data = read_json_stdin(args.stream)
     else:
-        json_data = read_json_file(args.json)
+        json_data = read_json_file(json_file, args.stream)
 
     if isinstance(json_data, list):
         metadata = json_data[0];
     else:
         metadata = json_data;
 
-    if (args.verbose > 4):
+    if cfg.v5:
         # Very noisy, but useful for debugging:
         #print("read json.\n")
         show_json(json_data)
 
+    # Resolve the path only once, and do all xattr calls on the descriptor:
+    # (or on the path, if the target can't be opened)
+    fd = open_target(target)
+    try:
+        if (args.clear_first):
+            if cfg.v1:
+                print("Removing existing xattrs from {}...".format(target))
+            clear_xattrs(fd, cfg.jobs)
 
-    if (args.verbose > 3):
-        show_xattr_limits()    # nice, but verbose
-
-    if (args.clear_first):
-        if (args.verbose > 0):
-            print("Removing existing xattrs from {}...".format(target))
-        clear_xattrs(target)
+        # Use the JSON input as metadata to write:
+        #metadata = json_data[0]
+        try:
+            written = write_xattrs(target, metadata, prefix, cfg, fd)
+        except Exception as e:
+            print("Failed on '{}'.".format(target))
+            raise(e)
 
-    # Use the JSON input as metadata to write:
-    #metadata = json_data[0]
+        xattrs = read_xattrs(fd)
+        if cfg.v4:
+            print("\nRead xattrs keys from target:")
+            print(xattrs)  # pretty verbose. But nice to see what's happening.
+            print("Total size of xattrs on target: {}".format(
+                convert_bytes(get_xattrs_size(fd))
+                ))
+    except OSError as e:
+        name_target_error(e, fd, target)
+        raise
+    finally:
+        close_target(fd)
+
+# Same as process_target(), but for one of many targets: reports errors
+# instead of raising them, so the other targets still get done.
+# Returns True on success.
+def try_target(target, json_file, args, cfg):
     try:
-        written = write_xattrs(target, metadata, prefix=prefix, archive=args.archive)
+        process_target(target, json_file, args, cfg)
     except Exception as e:
-        print("Failed.")
-        raise(e)
+        print("ERROR: could not write xattrs from '{}' to '{}': {}".format(json_file, target, e))
+        return False
+    return True
+
+def main():
+    # Get commandline arguments/options:
+    args = get_args()
+    handle_args(args)
+    cfg = Cfg.from_args(args)
+
+    #print("parsed args.")
+
+    if cfg.v4:
+        show_xattr_limits()    # nice, but verbose
 
-    xattrs = read_xattrs(target)
-    if (args.verbose > 3):
-        print("\nRead xattrs keys from target:")
-        print(xattrs)  # pretty verbose. But nice to see what's happening.
+    if args.target_list is None:
+        process_target(args.target, args.json, args, cfg)
+        return
+
+    # Many targets in one go, so startup is only paid once:
+    targets = read_target_list(args.target_list)
+    if (cfg.jobs > 1):
+        # Spread the files over the threads, rather than the keys of each file:
+        from concurrent.futures import ThreadPoolExecutor
+
+        file_cfg = cfg._replace(jobs=1)
+        with ThreadPoolExecutor(max_workers=cfg.jobs) as executor:
+            results = list(executor.map(
+                lambda pair: try_target(pair[0], pair[1], args, file_cfg),
+                targets
+                ))
+    else:
+        results = [try_target(target, json_file, args, cfg)
+                for target, json_file in targets]
+
+    # Like calling j2x once per file: keep going, but let the caller know.
+    failed = results.count(False)
+    if failed:
+        print("ERROR: {} of {} targets failed.".format(failed, len(targets)))
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
-
@@ -1,7 +1,9 @@
 """Enable iterative testing of J2X."""
 
-import argparse
+import json
+import os
 import pathlib
+import time
 import pytest
 
 from dataclasses import dataclass
@@ -10,26 +12,13 @@ from typing import Final
 from helpers import j2x
 
 
-DEFAULT_PREFIX: Final[str] = "user."
+DEFAULT_PREFIX: Final[bytes] = b"user."
 
 
 @pytest.fixture
-def args():
-    """Create an args object to be used by functions requiring this.
-
-    NB. Eventually it would be good to remove this to avoid use of
-        globals.
-    """
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        action="count",
-        default=0,
-        help="Increase verbosity level.",
-    )
-    args = parser.parse_args()
-    return args
+def cfg():
+    """Create a config object to be used by functions requiring this."""
+    return j2x.Cfg(archive=True)
 
 
 @dataclass
@@ -60,7 +49,7 @@ write_attr_tests = [
 @pytest.mark.parametrize("file_name, input_attrs, stored_attrs", write_attr_tests)
 def test_write_xtattr(
     tmp_path: pathlib.Path,
-    args: argparse.Namespace,
+    cfg: j2x.Cfg,
     file_name: str,
     input_attrs: KeyValue,
     stored_attrs: list,
@@ -70,9 +59,383 @@ def test_write_xtattr(
         assert False, "test hasn't been configured correctly"
     path = tmp_path / file_name
     path.touch()
-    j2x.args = args
     for attr in input_attrs:
-        j2x.write_xattr(path, attr.key, attr.value, DEFAULT_PREFIX)
+        written = j2x.write_xattr(path, attr.key, attr.value, DEFAULT_PREFIX, cfg)
+        assert written == (len(DEFAULT_PREFIX) + len(attr.key), len(attr.value))
     res = j2x.read_xattrs(path)
     assert len(res) == len(stored_attrs)
     assert set(res) == set(stored_attrs)
+
+
+def test_get_xattrs_size(tmp_path: pathlib.Path, cfg: j2x.Cfg):
+    """Ensure the size of stored xattrs is counted in bytes."""
+    path = tmp_path / "file"
+    path.touch()
+    j2x.write_xattr(path, "k1", "v1", DEFAULT_PREFIX, cfg)
+    j2x.write_xattr(path, "k2", "wörd", DEFAULT_PREFIX, cfg)
+    assert j2x.get_xattrs_size(path) == len("user.k1v1") + len("user.k2wörd".encode())
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_read_json_file(tmp_path: pathlib.Path, monkeypatch, use_orjson: bool):
+    """Ensure JSON files are read the same with and without orjson."""
+    if use_orjson:
+        pytest.importorskip("orjson")
+        monkeypatch.setattr(j2x, "ORJSON_MIN_SIZE", 0)
+    path = tmp_path / "data.json"
+    path.write_text('[{"k1": "v1", "k2": 2}]', encoding="utf-8")
+    assert j2x.read_json_file(path) == [{"k1": "v1", "k2": 2}]
+
+
+parse_json_tests = [
+    b'[{"id": 123456789012345678901234567890}]',
+    b'[{"id": -9223372036854775809}]',
+    b'[{"nan": NaN, "inf": Infinity}]',
+    b'[{"text": "\\ud800"}]',
+]
+
+
+@pytest.mark.parametrize("raw", parse_json_tests)
+def test_parse_json_like_json(monkeypatch, raw: bytes):
+    """Ensure orjson never changes (or rejects) what json would parse."""
+    pytest.importorskip("orjson")
+    monkeypatch.setattr(j2x, "ORJSON_MIN_SIZE", 0)
+    assert repr(j2x.parse_json(raw)) == repr(json.loads(raw))
+
+
+def test_write_xattrs_big_integer(tmp_path: pathlib.Path, monkeypatch):
+    """Ensure integers beyond 64 bits are written with all their digits."""
+    monkeypatch.setattr(j2x, "ORJSON_MIN_SIZE", 0)
+    path = tmp_path / "file"
+    path.touch()
+    json_file = tmp_path / "data.json"
+    json_file.write_text('[{"id": 123456789012345678901234567890}]', encoding="utf-8")
+    metadata = j2x.read_json_file(json_file)[0]
+    j2x.write_xattrs(path, metadata, "user.", j2x.Cfg(archive=True, quiet=True))
+    assert os.getxattr(path, "user.id") == b"123456789012345678901234567890"
+
+
+def test_write_and_clear_xattrs_jobs(tmp_path: pathlib.Path):
+    """Ensure writing and clearing with several threads covers all keys."""
+    path = tmp_path / "file"
+    path.touch()
+    data = {f"k{idx}": f"v{idx}" for idx in range(20)}
+    cfg = j2x.Cfg(archive=True, quiet=True, jobs=4)
+    j2x.write_xattrs(path, data, "user.", cfg)
+    assert set(j2x.read_xattrs(path)) == {f"user.{key}" for key in data}
+    j2x.clear_xattrs(path, jobs=4)
+    assert j2x.read_xattrs(path) == []
+
+
+clean_tests = [
+    ("key", "key"),
+    (" key\t", "key"),
+    ("Key With Space", "key with space"),
+    (42, "42"),
+    ("", ""),
+]
+
+
+@pytest.mark.parametrize("raw, cleaned", clean_tests)
+def test_clean_key_value(raw, cleaned: str):
+    """Ensure keys and values are stripped, converted and lowercased."""
+    cfg = j2x.Cfg(lower_key=True, lower_value=True)
+    assert j2x.clean_key(raw, cfg) == cleaned
+    assert j2x.clean_value(raw, cfg) == cleaned
+
+
+def test_write_xattrs_keeps_existing(tmp_path: pathlib.Path):
+    """Ensure existing xattrs are left alone and not counted as written."""
+    path = tmp_path / "file"
+    path.touch()
+    cfg = j2x.Cfg(archive=True, quiet=True)
+    j2x.write_xattrs(path, {"k1": "old"}, "user.", cfg)
+    written = j2x.write_xattrs(path, {"k1": "new", "k2": "v2"}, "user.", cfg)
+    assert written == {"keys": len("user.k2"), "values": 2, "sum": len("user.k2") + 2}
+    assert set(j2x.read_xattrs(path)) == {"user.k1", "user.k2"}
+    assert os.getxattr(path, "user.k1") == b"old"
+
+
+fast_args_tests = [
+    ["-t", "file", "-j", "-"],
+    ["--target", "file", "--json", "data.json", "-p", "user.exif."],
+    ["-t", "file", "-j", "-", "-v", "-v", "-q", "-a", "-c", "-ev", "--stream"],
+    ["-lk", "-lv", "-t", "file", "-j", "data.json", "--verbose"],
+]
+
+
+@pytest.mark.parametrize("argv", fast_args_tests)
+def test_fast_parse_args(argv: list):
+    """Ensure the fast path parses plain invocations like argparse does."""
+    args = j2x.fast_parse_args(argv)
+    assert args is not None
+    assert vars(args) == vars(j2x.parse_args().parse_args(argv))
+
+
+fallback_args_tests = [
+    ["-h"],
+    ["-t", "file"],
+    ["-t", "file", "-j", "-", "-vv"],
+    ["-t", "file", "-j", "-", "--jobs", "4"],
+    ["-t", "-j", "data.json"],
+    ["-t", "file", "-j"],
+]
+
+
+@pytest.mark.parametrize("argv", fallback_args_tests)
+def test_fast_parse_args_fallback(argv: list):
+    """Ensure anything beyond plain invocations is left to argparse."""
+    assert j2x.fast_parse_args(argv) is None
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_target_list(tmp_path: pathlib.Path, monkeypatch, jobs: str):
+    """Ensure all targets from a target list get their xattrs written."""
+    lines = []
+    for idx in range(3):
+        target = tmp_path / f"file{idx}"
+        target.touch()
+        json_file = tmp_path / f"file{idx}.json"
+        json_file.write_text(f'[{{"k{idx}": "v{idx}"}}]', encoding="utf-8")
+        lines.append(f"{target}\t{json_file}")
+    target_list = tmp_path / "targets.txt"
+    target_list.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    monkeypatch.setattr(
+        "sys.argv", ["j2x", "-q", "--jobs", jobs, "--target-list", str(target_list)]
+    )
+    j2x.main()
+    for idx in range(3):
+        assert j2x.read_xattrs(tmp_path / f"file{idx}") == [f"user.k{idx}"]
+
+
+def test_read_json_file_stream(tmp_path: pathlib.Path):
+    """Ensure streaming returns the first record of a JSON list."""
+    path = tmp_path / "data.json"
+    path.write_text('[{"k1": "v1", "k2": 2.5}, {"k3": "v3"}]', encoding="utf-8")
+    assert j2x.read_json_file(path, stream=True)[0] == {"k1": "v1", "k2": 2.5}
+
+
+convert_bytes_tests = [
+    (0, 1024.0, "0.0 bytes"),
+    (1023, 1024.0, "1023.0 bytes"),
+    (1024, 1024.0, "1.0 kB"),
+    (1536, 1024.0, "1.5 kB"),
+    (65536, 1024.0, "64.0 kB"),
+    (3 * 1024**3, 1024.0, "3.0 GB"),
+    (2 * 1024**5, 1024.0, "2048.0 TB"),
+    (999, 1000.0, "999.0 bytes"),
+    (1500, 1000.0, "1.5 kB"),
+    (2 * 1000**5, 1000.0, "2000.0 TB"),
+]
+
+
+@pytest.mark.parametrize("num, step_unit, expected", convert_bytes_tests)
+def test_convert_bytes(num: int, step_unit: float, expected: str):
+    """Ensure byte counts are shown in the right unit."""
+    assert j2x.convert_bytes(num, step_unit) == expected
+
+
+@pytest.mark.parametrize("empty_values", [True, False])
+def test_write_xattrs_archive(tmp_path: pathlib.Path, empty_values: bool):
+    """Ensure archive mode keeps keys/values as they are."""
+    path = tmp_path / "file"
+    path.touch()
+    cfg = j2x.Cfg(archive=True, empty_values=empty_values, quiet=True)
+    j2x.write_xattrs(path, {"Key": " Value ", "num": 42, "empty": ""}, "user.", cfg)
+    assert os.getxattr(path, "user.Key") == b" Value "
+    assert os.getxattr(path, "user.num") == b"42"
+    assert ("user.empty" in j2x.read_xattrs(path)) == empty_values
+
+
+def test_write_xattrs_list(tmp_path: pathlib.Path):
+    """Ensure a list of key/value objects can be stored as xattrs."""
+    path = tmp_path / "file"
+    path.touch()
+    data = [{"key": "k1", "value": "v1"}, {"key": "k2", "value": "v2"}]
+    cfg = j2x.Cfg(archive=True, quiet=True)
+    j2x.write_xattrs(path, data, "user.", cfg)
+    assert os.getxattr(path, "user.k1") == b"v1"
+    assert os.getxattr(path, "user.k2") == b"v2"
+
+
+def test_write_xattrs_unreadable_target(tmp_path: pathlib.Path, monkeypatch):
+    """Ensure targets that can't be opened for reading are written by path."""
+    path = tmp_path / "file"
+    path.touch()
+
+    def no_open(*args, **kwargs):
+        raise PermissionError(13, "Permission denied")
+
+    monkeypatch.setattr(j2x.os, "open", no_open)
+    assert j2x.open_target(path) == path
+    cfg = j2x.Cfg(archive=True, quiet=True)
+    j2x.write_xattrs(path, {"k1": "v1"}, "user.", cfg)
+    assert os.getxattr(path, "user.k1") == b"v1"
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="root can read any file")
+def test_main_write_only_target(tmp_path: pathlib.Path, monkeypatch):
+    """Ensure a write-only target still gets its xattrs (like setfattr)."""
+    path = tmp_path / "file"
+    path.touch()
+    path.chmod(0o200)
+    json_file = tmp_path / "file.json"
+    json_file.write_text('[{"k1": "v1"}]', encoding="utf-8")
+    monkeypatch.setattr("sys.argv", ["j2x", "-q", "-t", str(path), "-j", str(json_file)])
+    j2x.main()
+    path.chmod(0o600)
+    assert j2x.read_xattrs(path) == ["user.k1"]
+
+
+def test_cfg_levels():
+    """Ensure the verbosity levels follow the verbosity, also on _replace()."""
+    cfg = j2x.Cfg(verbose=3)
+    assert (cfg.v1, cfg.v2, cfg.v3, cfg.v4, cfg.v5) == (True, True, True, False, False)
+    cfg = cfg._replace(verbose=5, jobs=2)
+    assert cfg.v5 and cfg.jobs == 2
+    assert cfg._replace(verbose=0).v1 is False
+
+
+stream_tests = [
+    ('{"k1": "v1", "k2": 2}', {"k1": "v1", "k2": 2}),
+    ('[{"k1": "v1"}, {"k2": "v2"}]', [{"k1": "v1"}]),
+    ('[{"id": 123456789012345678901234567890}]', [{"id": 123456789012345678901234567890}]),
+]
+
+
+@pytest.mark.parametrize("text, expected", stream_tests)
+def test_read_json_file_stream_ijson(tmp_path: pathlib.Path, text: str, expected):
+    """Ensure streaming handles objects and big integers like json does."""
+    pytest.importorskip("ijson")
+    path = tmp_path / "data.json"
+    path.write_text(text, encoding="utf-8")
+    assert j2x.read_json_file(path, stream=True) == expected
+
+
+def test_read_json_file_stream_empty_list(tmp_path: pathlib.Path):
+    """Ensure streaming an empty list reports a clear error."""
+    pytest.importorskip("ijson")
+    path = tmp_path / "data.json"
+    path.write_text("[]", encoding="utf-8")
+    with pytest.raises(ValueError, match="No records"):
+        j2x.read_json_file(path, stream=True)
+
+
+def test_load_json_stream_big_integer_pipe():
+    """Ensure big integers in piped input give a clear error when streaming."""
+    ijson = pytest.importorskip("ijson")
+    if ijson.backend != "yajl2_c":
+        pytest.skip("only the C backend is limited to 64 bit integers")
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'[{"id": 123456789012345678901234567890}]')
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as pipe:
+        with pytest.raises(ValueError, match="beyond 64 bits"):
+            j2x.load_json(pipe, stream=True)
+
+
+def test_open_target_only_files_and_dirs(tmp_path: pathlib.Path):
+    """Ensure only regular files and directories are opened."""
+    fifo = tmp_path / "fifo"
+    os.mkfifo(fifo)
+    assert j2x.open_target(fifo) == fifo
+    missing = tmp_path / "missing"
+    assert j2x.open_target(missing) == missing
+    for path in (tmp_path, tmp_path / "file"):
+        path.touch()
+        fd = j2x.open_target(path)
+        assert isinstance(fd, int)
+        j2x.close_target(fd)
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_write_xattrs_stops_at_error(tmp_path: pathlib.Path, monkeypatch, jobs: int):
+    """Ensure writing stops at the first failing key, with or without threads."""
+    path = tmp_path / "file"
+    path.touch()
+    written = []
+
+    def fake_write_xattr(target, key, value, prefix_b, cfg, existing=None):
+        if key == "bad":
+            raise OSError(7, "Argument list too long")
+        time.sleep(0.01)
+        written.append(key)
+        return (len(prefix_b) + len(key), len(value))
+
+    monkeypatch.setattr(j2x, "write_xattr", fake_write_xattr)
+    data = {"bad": "x"}
+    data.update({f"k{idx}": "v" for idx in range(40)})
+    cfg = j2x.Cfg(quiet=True, jobs=jobs)
+    with pytest.raises(OSError):
+        j2x.write_xattrs(path, data, "user.", cfg)
+    # Only keys already being written when "bad" failed may have made it:
+    assert len(written) < jobs
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_target_list_failing_entry(
+    tmp_path: pathlib.Path, monkeypatch, capsys, jobs: str
+):
+    """Ensure a failing target doesn't stop the others, but still fails the run."""
+    values = ["v", "x" * 70000, "v"]
+    lines = []
+    for idx, value in enumerate(values):
+        target = tmp_path / f"file{idx}"
+        target.touch()
+        json_file = tmp_path / f"file{idx}.json"
+        json_file.write_text(json.dumps([{"k": value}]), encoding="utf-8")
+        lines.append(f"{target}\t{json_file}")
+    target_list = tmp_path / "targets.txt"
+    target_list.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    monkeypatch.setattr(
+        "sys.argv", ["j2x", "-q", "--jobs", jobs, "--target-list", str(target_list)]
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        j2x.main()
+    assert exit_info.value.code == 1
+    assert [j2x.read_xattrs(tmp_path / f"file{idx}") for idx in range(3)] == [
+        ["user.k"],
+        [],
+        ["user.k"],
+    ]
+    out = capsys.readouterr().out
+    assert f"'{tmp_path / 'file1'}'" in out
+    assert "1 of 3 targets failed" in out
+
+
+def test_load_json_stream_big_integer_offset(tmp_path: pathlib.Path):
+    """Ensure re-reading big integers starts where the JSON data starts."""
+    pytest.importorskip("ijson")
+    path = tmp_path / "data.txt"
+    path.write_bytes(b'header\n[{"id": 123456789012345678901234567890}]')
+    with open(path, "rb") as fp:
+        fp.readline()
+        assert j2x.load_json(fp, stream=True) == [{"id": 123456789012345678901234567890}]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_write_xattrs_error_names_target(
+    tmp_path: pathlib.Path, capsys, jobs: int
+):
+    """Ensure errors name the target file, not its file descriptor."""
+    path = tmp_path / "file"
+    path.touch()
+    cfg = j2x.Cfg(quiet=True, jobs=jobs)
+    with pytest.raises(OSError) as error:
+        j2x.write_xattrs(path, {"k": "x" * 70000}, "user.", cfg)
+    assert error.value.filename == path
+    assert str(path) in str(error.value)
+    assert f"on '{path}'" in capsys.readouterr().out
+
+
+def test_main_error_names_target(tmp_path: pathlib.Path, monkeypatch, capsys):
+    """Ensure a failed run names the target file."""
+    path = tmp_path / "file"
+    path.touch()
+    json_file = tmp_path / "file.json"
+    json_file.write_text(json.dumps([{"k": "x" * 70000}]), encoding="utf-8")
+    monkeypatch.setattr("sys.argv", ["j2x", "-q", "-t", str(path), "-j", str(json_file)])
+    with pytest.raises(OSError) as error:
+        j2x.main()
+    assert str(path) in str(error.value)
+    assert f"Failed on '{path}'." in capsys.readouterr().out